@@ -140,7 +140,7 @@ def cluster(resultset):
     grid_colors = defaultdict(list)
     grid_scores = defaultdict(list)
     count_outlier = 0
-    s_scores = metrics.silhouette_samples([e.encoding for e in atlas.elements], db.labels_)
+    s_scores = metrics.silhouette_samples(atlas.encodings, db.labels_)
     for idx, (img, label, score) in enumerate(zip(face_images, db.labels_, s_scores)):
         if img is not None:
             #centroid = km.cluster_centers_[label]
@@ -2,7 +2,9 @@ from .faces import (
     # first, the classes
     Shape, Shape5p, Shape68p, Face, Atlas,
     # and now the functions
-    detect, landmark, encode, compare, estimate_gender
+    detect, detect_cnn, detect_cnn_batch, detect_many, landmark, encode, encode_many, process,
+    compare, compare_many, estimate_gender, estimate_gender_many, preload, preprocess,
+    set_preproc_device
     # and not much more for now
 )
 
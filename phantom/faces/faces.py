@@ -18,13 +18,32 @@ https://github.com/davisking/dlib-models
 
 import cv2
 import dlib
+import functools
+import itertools
+import json
+import math
 import numpy as np
+import os
 import pickle
+import pickletools
+import threading
 
 
-from pkg_resources import resource_filename
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sklearn.cluster import DBSCAN, KMeans
 
+try:
+    from importlib.resources import files
+except ImportError:
+    files = None  # Python < 3.9, fall back to the (much slower) pkg_resources
+    from pkg_resources import resource_filename
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None  # xxhash is optional, hashing falls back to python's hash()
+
 
 class _LazyStore:
     def __init__(self, d=None, r=None):
@@ -34,49 +53,157 @@ class _LazyStore:
             r = {}
         self.dict = d
         self.reg  = r
+        self.optional = set()
+        self._lock = threading.Lock()
     
-    def register(self, key, initer, *args, **kwargs):
+    def register(self, key, initer, *args, optional=False, **kwargs):
         self.reg[key] = (initer, args, kwargs)
+        if optional:
+            # not needed for the basic features (eg: models that aren't
+            # shipped, or are expensive), so `warm` skips them by default
+            self.optional.add(key)
     
     def get(self, key):
         try:
             return self.dict[key]
         except KeyError:
             pass  # don't want to nest try blocks
-        # so we're here, without our key
-        try:
-            func, args, kwargs = self.reg[key]
-            store = func(*args, **kwargs)
-        except KeyError:
-            raise KeyError("unregistered lazy key.")
-        self.dict[key] = store
+        # so we're here, without our key -- load it only once, even if many
+        # threads ask for it at the same time
+        with self._lock:
+            if key in self.dict:
+                return self.dict[key]
+            try:
+                func, args, kwargs = self.reg[key]
+                store = func(*args, **kwargs)
+            except KeyError:
+                raise KeyError("unregistered lazy key.")
+            self.dict[key] = store
         return store
 
+    def warm(self, keys=None):
+        """
+        Loads the given keys (or every registered key that isn't optional) right
+        away, instead of waiting for their first use.
+
+        :param keys: iterable of registered keys, or None for all of the
+            non-optional ones
+        """
+        if keys is None:
+            keys = [key for key in self.reg if key not in self.optional]
+        for key in keys:
+            self.get(key)
+
+
+class _LruStore:
+    """
+    A small thread-safe least-recently-used store, that forgets the oldest keys
+    once it grows over `maxsize`.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.dict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self.dict.move_to_end(key)
+            except KeyError:
+                return None
+            return self.dict[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self.dict[key] = value
+            self.dict.move_to_end(key)
+            if len(self.dict) > self.maxsize:
+                self.dict.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.dict.clear()
 
+
+def _digest(img):
+    """
+    Fast content hash of an image, used to key the encoding cache.
+
+    :param img: numpy/cv2 image array
+    :return: int
+    """
+    data = np.ascontiguousarray(img)
+    if xxhash is None:
+        return hash(data.tobytes())
+    return xxhash.xxh64(data).intdigest()
+
+
+@functools.lru_cache(maxsize=8)
 def _unpickle(path):
     """
     A simple wrapper to keep the loading of pickled models sane, and in line
     with the code style.
+
+    Results are memoized, so a model is deserialized only once per path even if
+    `lazy_vars` gets cleared.
     """
     with open(path, "rb") as filehandle:
         obj = pickle.load(filehandle)
     return obj
 
 
+def _load_yunet(path):
+    """
+    Builds OpenCVs YuNet face detector (`cv2.FaceDetectorYN`), running on CPU.
+
+    The input size is set on each call to `detect`, since it has to match the
+    image being processed.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"YuNet model not found at {path}. Download face_detection_yunet_2023mar.onnx "
+            "from https://github.com/opencv/opencv_zoo into phantom/models."
+        )
+    return cv2.FaceDetectorYN.create(
+        path, "", (0, 0), score_threshold=0.9, nms_threshold=0.3, top_k=5000,
+        backend_id=cv2.dnn.DNN_BACKEND_OPENCV, target_id=cv2.dnn.DNN_TARGET_CPU
+    )
+
+
+def _resource_path(path):
+    """
+    Path to a file inside the phantom package.
+
+    :param path: path relative to the package root
+    :return: str, full path to the file
+    """
+    if files is None:
+        return resource_filename("phantom", path)
+    return str(files("phantom").joinpath(path))
+
+
 # paths for the model files
-_path_encoder   = resource_filename("phantom", "models/dlib_face_recognition_resnet_model_v1.dat")
+_path_detector_cnn = _resource_path("models/mmod_human_face_detector.dat")
+_path_detector_yunet = _resource_path("models/face_detection_yunet_2023mar.onnx")
+_path_encoder   = _resource_path("models/dlib_face_recognition_resnet_model_v1.dat")
 if dlib.__version__.startswith("19.8"):
-    _path_gender    = resource_filename("phantom", "models/phantom_gender_model_v1_dlib_19.8.dat")
+    _path_gender    = _resource_path("models/phantom_gender_model_v1_dlib_19.8.dat")
 else:
-    _path_gender    = resource_filename("phantom", "models/phantom_gender_model_v1.dat")
-_path_shape_5p  = resource_filename("phantom", "models/shape_predictor_5_face_landmarks.dat")
-_path_shape_68p = resource_filename("phantom", "models/shape_predictor_68_face_landmarks.dat")
+    _path_gender    = _resource_path("models/phantom_gender_model_v1.dat")
+_path_shape_5p  = _resource_path("models/shape_predictor_5_face_landmarks.dat")
+_path_shape_68p = _resource_path("models/shape_predictor_68_face_landmarks.dat")
 # and we instance the models
 # scrub that -- lazy load them, with a lazy store
 lazy_vars = _LazyStore()
 lazy_vars.register(
     "face_detector", dlib.get_frontal_face_detector
 )
+lazy_vars.register(
+    "face_detector_cnn", dlib.cnn_face_detection_model_v1, _path_detector_cnn, optional=True
+)
+lazy_vars.register(
+    "face_detector_yunet", _load_yunet, _path_detector_yunet, optional=True
+)
 lazy_vars.register(
     "face_encoder", dlib.face_recognition_model_v1, _path_encoder
 )
@@ -93,18 +220,84 @@ lazy_vars.register(
     "shape_predictor_68p", dlib.shape_predictor, _path_shape_68p
 )
 #shape_predictor_68p = dlib.shape_predictor(_path_shape_68p)
+# models that can't be used from many threads at once. Tasks of `detect_many`
+# and `encode_many` check out a store with their own copy of these (see
+# `_run_with_models`)
+_per_thread_keys = (
+    "face_detector", "face_detector_cnn", "face_detector_yunet", "face_encoder"
+)
+_thread_models = threading.local()
+# idle worker stores, kept across calls so each copy of the models is loaded
+# only once
+_worker_stores = []
+_worker_stores_lock = threading.Lock()
+_worker_stores_made = 0
+# encodings already computed by `encode`, keyed by image contents, face
+# location, shape model and jitter
+_encoding_cache = _LruStore(4096)
+# where `preprocess` runs, see `set_preproc_device`
+_preproc_device = "cpu"
+# OpenCL setting of OpenCV before switching to "gpu", restored on "cpu"
+_opencl_before = None
+
+
+def _encode_batch_single(face_encoder, img, shapelist, jitter):
+    """
+    Encodes every shape in `shapelist` with one call to the encoder per face.
+
+    Used with dlib versions that lack the vector overload of
+    `compute_face_descriptor`.
+    """
+    return [face_encoder.compute_face_descriptor(img, shape, jitter) for shape in shapelist]
+
+
+def _encode_batch_vector(face_encoder, img, shapelist, jitter):
+    """
+    Encodes every shape in `shapelist` with a single call to the encoder, so
+    dlib can batch the forward pass of the network.
+    """
+    shapes = dlib.full_object_detections(shapelist)
+    return face_encoder.compute_face_descriptor(img, shapes, jitter)
+
+
+def _encode_chips(face_encoder, img, shapelist, jitter):
+    """
+    Crops and aligns each face once into a 150x150 chip (what the encoder
+    works on), and encodes all the chips in a single call. Jittering then works
+    over the small chips instead of the whole image.
+    """
+    shapes = dlib.full_object_detections(shapelist)
+    chips = dlib.get_face_chips(img, shapes, size=150, padding=0.25)
+    return face_encoder.compute_face_descriptor(chips, jitter)
+
+
+if dlib.__version__.startswith("19.8"):
+    _encode_batch = _encode_batch_single
+else:
+    _encode_batch = _encode_batch_vector
+# encoding pre-aligned face chips is only available from dlib 19.17 onwards
+if tuple(int(v) for v in dlib.__version__.split(".")[:2]) >= (19, 17):
+    _encode_aligned = _encode_chips
+else:
+    _encode_aligned = _encode_batch
 
 
 class Shape:
     """
     Represents the shape of a face, as returned from a facial landmark detector.
 
+    `self.dict` maps the name of each region of the face to a (K, 2) int32
+    np.ndarray with its points.
+
     :param points: ordered list of points, according to a landmark definition.
     """
 
     def __init__(self, points):
         self.points = points
         self.dict = {}
+        # points as an (N, 2) int32 array, the way cv2 drawing functions take them
+        self._pts = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+        self._polylines = []  # to be filled by subclasses in _make_dict
         self._make_dict()
         self.model = None  # to be overridden by subclasses
     
@@ -126,8 +319,10 @@ class Shape:
         Subclasses can define the logic for drawing this shape over an image,
         using points, however a base implementation is provided.
         """
-        for point in self.points:
-            cv2.circle(img, point, thick, color, thickness=thick)
+        # each point becomes a zero-length segment, which cv2 draws as a round
+        # dot -- this way all the points are drawn with a single call
+        dots = np.repeat(self._pts[:, np.newaxis], 2, axis=1)
+        cv2.polylines(img, dots, False, color, thickness=3 * thick)
         return None
     
     def _draw_numbers(self, img, color, thick):
@@ -142,25 +337,25 @@ class Shape5p(Shape):
     """
     5-point facial landmarks Shape object.
     """
+    # indexes of the points of each region, shared by every instance
+    _regions = {
+        "eye_left":  slice(0, 2),
+        "eye_right": slice(2, 4),
+        "nose":      slice(4, 5),
+    }
+    # eye_left + nose + eye_right (reversed), drawn as a single line
+    _line = np.array([0, 1, 4, 3, 2])
+
     def __init__(self, points):
         super().__init__(points)
         self.model = lazy_vars.get("shape_predictor_5p")
 
     def _make_dict(self):
-        p = self.points
-        self.dict = {
-            "eye_left":   p[0:2],
-            "eye_right":  p[2:4],
-            "nose":      [p[4]],
-        }
+        self.dict = {k: self._pts[v] for k, v in self._regions.items()}
+        self._polylines = [self._pts[self._line].reshape(-1, 1, 2)]
     
     def _draw_lines(self, img, color, thick):
-        d = self.dict
-        points = d["eye_left"] + d["nose"] + d["eye_right"][::-1]
-        pairs = list(zip(points[:-1], points[1:]))
-        # print(pairs)
-        for point1, point2 in pairs:
-            cv2.line(img, point1, point2, color, thickness=thick)
+        cv2.polylines(img, self._polylines, False, color, thickness=thick)
         return None
 
 
@@ -168,39 +363,118 @@ class Shape68p(Shape):
     """
     68-point facial landmarks Shape object.
     """
+    # indexes of the points of each region, shared by every instance
+    _regions = {
+        "jawline":       slice(0, 17),
+        "eyebrow_right": slice(17, 22),
+        "eyebrow_left":  slice(22, 27),
+        "nose_bridge":   slice(27, 31),
+        "nose_tip":      slice(31, 36),
+        "eye_right":     slice(36, 42),
+        "eye_left":      slice(42, 48),
+        "lips_top":      np.array([48, 49, 50, 51, 52, 53, 54, 64, 63, 62, 61, 60]),
+        "lips_bottom":   np.array([54, 55, 56, 57, 58, 59, 48, 60, 67, 66, 65, 64]),
+        # "mouth":         ...,  # gotta check if it's usefull to implement this
+    }
+
     def __init__(self, points):
         super().__init__(points)
         self.model = lazy_vars.get("shape_predictor_68p")
 
     def _make_dict(self):
-        p = self.points
-        self.dict = {
-            "jawline":       p[0:17],
-            "eyebrow_right": p[17:22],
-            "eyebrow_left":  p[22:27],
-            "nose_bridge":   p[27:31],
-            "nose_tip":      p[31:36],
-            "eye_right":     p[36:42],
-            "eye_left":      p[42:48],
-            "lips_top":      p[48:55] + p[64:59:-1],
-            "lips_bottom":   p[54:60] + [p[48], p[60]] + p[67:63:-1],
-            # "mouth":         p[],  # gotta check if it's usefull to implement this
-        }
+        self.dict = {k: self._pts[v] for k, v in self._regions.items()}
+        self._polylines = [region.reshape(-1, 1, 2) for region in self.dict.values()]
     
     def _draw_lines(self, img, color, thick):
-        shape = self.dict
-        color_ = color
-        for key in shape:
-            pairs = zip(shape[key][:-1], shape[key][1:])
-            if key == "right_eye":
-                color_ = (0, 0, 255)
-            else:
-                color_ = color
-            for point1, point2 in pairs:
-                cv2.line(img, point1, point2, color_, thickness=thick)
+        cv2.polylines(img, self._polylines, False, color, thickness=thick)
         return None
 
 
+# lazy key of the shape predictor behind each `Shape` subclass
+_shape_model_key = {
+    Shape5p:  "shape_predictor_5p",
+    Shape68p: "shape_predictor_68p",
+}
+
+
+def _get_model(key):
+    """
+    Helper function.
+
+    Same as `lazy_vars.get`, except inside the workers of `detect_many` and
+    `encode_many`, which get their own copy of the models that aren't safe to
+    share between threads.
+
+    :param key: registered lazy key
+    :return: the model
+    """
+    store = getattr(_thread_models, "store", None)
+    if store is not None and key in _per_thread_keys:
+        return store.get(key)
+    return lazy_vars.get(key)
+
+
+def _checkout_models():
+    """
+    Helper function.
+
+    Takes an idle worker store, or makes a new one if all are in use. The first
+    store ever made starts with the models already loaded in `lazy_vars` (eg:
+    by `preload`), since the caller is blocked waiting on the workers and won't
+    use them meanwhile.
+
+    :return: `_LazyStore` for the models in `_per_thread_keys`
+    """
+    global _worker_stores_made
+    with _worker_stores_lock:
+        if _worker_stores:
+            return _worker_stores.pop()
+        loaded = {}
+        if _worker_stores_made == 0:
+            loaded = {k: v for k, v in lazy_vars.dict.items() if k in _per_thread_keys}
+        _worker_stores_made += 1
+    return _LazyStore(d=loaded, r=lazy_vars.reg)
+
+
+def _run_with_models(func, *args):
+    """
+    Runs `func(*args)` as a task of `detect_many`/`encode_many`, with a worker
+    store of its own that no other task uses at the same time. The store goes
+    back to the idle list afterwards, to be reused by later tasks and calls.
+    It has to be a module level function so it can be sent to worker processes.
+    """
+    store = _checkout_models()
+    _thread_models.store = store
+    try:
+        return func(*args)
+    finally:
+        _thread_models.store = None
+        with _worker_stores_lock:
+            _worker_stores.append(store)
+
+
+def _shape_predictor(model):
+    """
+    Helper function.
+
+    Gets the shape predictor behind a `Shape` subclass. The bundled models are
+    looked up directly; any other subclass (including subclasses of `Shape5p`
+    and `Shape68p`) is asked through a dummy instance, for its `model`.
+
+    :param model: `Shape` subclass that defines a landmarking model
+    :return: dlib shape predictor
+    """
+    key = _shape_model_key.get(model)
+    if key is not None:
+        return lazy_vars.get(key)
+    predictor = model([(i, i) for i in range(68)]).model
+    if predictor is None:
+        raise ValueError(
+            f"{model.__name__} doesn't define a landmarking model (`self.model`)."
+        )
+    return predictor
+
+
 class Face:
     """
     This is a convenience class that helps to gather, in a single place, the
@@ -231,42 +505,239 @@ class Atlas:
     """
     A large grouping of facial encodings.
 
-    :param encodings: list of facial encodings
+    The faces are kept by columns instead of as a list of `Face` objects:
+    `encodings` is a single (N, 128) matrix, and `images`, `origins`,
+    `locations` and `tags` hold the rest of the data of each face, in the same
+    order. `encodings_i8` is an int8 copy of the encodings (a quarter of the
+    size), with per-column factors in `scale`, for use with `compare_many`.
+
+    :param elements: list of `Face` objects, or None if the faces are passed as
+        separate columns with the keyword parameters
     :param path: the path to which the atlas will persist on disk
+    :param encodings: list of 128-d face encodings, or (N, 128) np.ndarray
+    :param images: list of np.ndarray/cv2 images for each face
+    :param origins: list of paths to the file each face comes from
+    :param locations: list of tuples (left, top, right, bottom) for each face
+    :param tags: list of dicts with the tags of each face
     """
-    def __init__(self, elements, path):
-        self.elements  = elements
+    # columns that are saved as raw arrays or in the json header, everything
+    # else in the atlas gets pickled to a sidecar file
+    _arrays = ("encodings", "encodings_i8", "scale", "origins", "locations")
+
+    def __init__(self, elements, path, *, encodings=None, images=None, origins=None,
+                 locations=None, tags=None):
+        if elements is not None:
+            encodings = [e.encoding for e in elements]
+            images    = [e.image for e in elements]
+            origins   = [e.origin for e in elements]
+            locations = [e.location for e in elements]
+            tags      = [e.tags for e in elements]
+        if encodings is None:
+            encodings = []
+        count = len(encodings)
+        self.encodings = _stack_encodings(encodings)
+        self.encodings_i8, self.scale = _quantize(self.encodings)
+        self.images    = list(images) if images is not None else [None] * count
+        self.origins   = _object_array(origins, count)
+        self.locations = _locations_array(locations, count)
+        self.tags      = list(tags) if tags is not None else [{} for _ in range(count)]
         self.clusters  = {}
         self.groups    = None
         self.grouped   = False
         self.path      = path
-        self._dbscan   = DBSCAN(eps=0.475, min_samples=2)
+        self._dbscan   = DBSCAN(eps=0.475, min_samples=2, metric="euclidean",
+                                algorithm="ball_tree", n_jobs=-1)
         self._kmeans   = None
     
-    def group(self):
+    def __len__(self):
+        return len(self.encodings)
+
+    def group(self, *, method="dbscan"):
         """
         Used clustering algorithms to group all the faces of the Atlas into
         distinct groups. These can later be used to match new faces, or compare
         to other Atlases.
+
+        After grouping, `self.groups` holds the label of each face (-1 for the
+        faces that didn't fit in any group) and `self.clusters` maps each label
+        to the indexes of its faces.
+
+        :param method: "dbscan" (default), or "hdbscan" which scales better on
+            very large atlases (tens of thousands of faces and up). HDBSCAN
+            needs scikit-learn 1.3+
         """
-        pass
+        if method == "dbscan":
+            clusterer = self._dbscan
+        elif method == "hdbscan":
+            from sklearn.cluster import HDBSCAN
+            clusterer = HDBSCAN(min_cluster_size=2, n_jobs=-1, copy=True)
+        else:
+            raise ValueError("Invalid value for `method` parameter.")
+        if len(self) < 2:
+            # no groups can be made, and HDBSCAN refuses a single sample
+            labels = np.full(len(self), -1, dtype=np.int64)
+        else:
+            labels = clusterer.fit_predict(self.encodings)
+        self.groups   = labels
+        self.clusters = {
+            int(label): np.where(labels == label)[0] for label in np.unique(labels) if label != -1
+        }
+        self.grouped  = True
     
     def load(self):
         """
-        Loads an Atlas from disk, read from `self.path`.
+        Loads an Atlas from disk, read from the files at `self.path` (see
+        `save`).
+
+        The encoding matrices are memory-mapped read-only instead of read, so
+        the OS pages them in as they're used, and processes that load the same
+        atlas share them. `self.encodings` is float16 after loading.
         """
-        with open(self.path, "rb") as fhandle:
+        path = self.path
+        with open(path + ".json", "r") as fhandle:
+            header = json.load(fhandle)
+        with open(path + ".meta", "rb") as fhandle:
             new_dict = pickle.load(fhandle)
+        count = header["n"]
+        shape = (count, header["d"])
         self.__dict__.clear()
         self.__dict__.update(new_dict)
+        self.path         = path  # the files may have been moved since saving
+        self.encodings    = _open_raw(path + ".f16", header["dtype"], shape)
+        self.encodings_i8 = _open_raw(path + ".i8", np.int8, shape)
+        self.scale        = np.asarray(header["scale"], dtype=np.float32)
+        self.origins      = _object_array(header["origins"], count)
+        self.locations    = np.asarray(header["locations"], dtype=np.int32).reshape(count, 4)
     
     def save(self):
         """
-        Persists the Atlas on disk, written to `self.path`.
+        Persists the Atlas on disk, written next to `self.path`:
+
+        * `self.path + ".f16"`: raw float16 encoding matrix
+        * `self.path + ".i8"`: raw int8 encoding matrix
+        * `self.path + ".json"`: header with the shape of the matrices, the
+          int8 scale, origins and locations
+        * `self.path + ".meta"`: everything else (images, tags, clusters...),
+          pickled
         """
-        with open(self.path, "wb") as fhandle:
-            pickle.dump(self.__dict__, fhandle)
+        count, dims = self.encodings.shape
+        header = {
+            "n": count,
+            "d": dims,
+            "dtype": "float16",
+            "scale": np.asarray(self.scale).tolist(),
+            "origins": list(self.origins),
+            "locations": np.asarray(self.locations).tolist(),
+        }
+        _write_raw(np.asarray(self.encodings, dtype=np.float16), self.path + ".f16")
+        _write_raw(np.asarray(self.encodings_i8, dtype=np.int8), self.path + ".i8")
+        with open(self.path + ".json", "w") as fhandle:
+            json.dump(header, fhandle, default=str)
+        meta = {k: v for k, v in self.__dict__.items() if k not in self._arrays}
+        data = pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.path + ".meta", "wb") as fhandle:
+            fhandle.write(pickletools.optimize(data))
+
+
+def _write_raw(array, path):
+    """
+    Helper function.
+
+    Writes the raw bytes of `array` to `path`. The file is written aside and
+    then moved into place, so atlases that have the old file memory-mapped
+    keep working.
+
+    :param array: np.ndarray
+    :param path: destination path
+    """
+    temp_path = path + ".tmp"
+    array.tofile(temp_path)
+    os.replace(temp_path, path)
+
 
+def _open_raw(path, dtype, shape):
+    """
+    Helper function.
+
+    Memory-maps (read-only) a raw array written by `_write_raw`.
+
+    :param path: path to the raw file
+    :param dtype: numpy dtype of the array
+    :param shape: shape of the array
+    :return: np.memmap, or an empty np.ndarray for empty arrays (which can't be
+        mapped)
+    """
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _stack_encodings(encodings):
+    """
+    Helper function.
+
+    Stacks a list of 128-d encodings into a contiguous (N, 128) float32 matrix,
+    so they can be compared in bulk with `compare_many`.
+
+    :param encodings: list of 128-d face encodings
+    :return: np.ndarray of shape (N, 128)
+    """
+    if len(encodings) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+    return np.ascontiguousarray(np.stack(encodings), dtype=np.float32)
+
+
+def _quantize(encodings):
+    """
+    Helper function.
+
+    Quantizes float encodings to int8, with one scale factor per column, so
+    that `encodings ~= quantized * scale`.
+
+    :param encodings: np.ndarray of shape (N, 128)
+    :return: tuple of (int8 np.ndarray of shape (N, 128), float32 np.ndarray
+        of 128 scale factors)
+    """
+    max_abs = np.abs(encodings).max(axis=0) if len(encodings) else np.zeros(128)
+    scale = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+    quantized = np.round(encodings / scale).astype(np.int8)
+    return quantized, scale
+
+
+def _object_array(values, count):
+    """
+    Helper function.
+
+    Packs a list of arbitrary python objects into a 1-d object np.ndarray,
+    without numpy trying to unpack them as extra dimensions.
+
+    :param values: list of objects, or None
+    :param count: length of the array (used when `values` is None)
+    :return: np.ndarray of dtype object
+    """
+    array = np.empty(count, dtype=object)
+    if values is not None:
+        array[:] = list(values)
+    return array
+
+
+def _locations_array(locations, count):
+    """
+    Helper function.
+
+    Packs a list of (left, top, right, bottom) tuples into an (N, 4) int32
+    np.ndarray. Missing locations (None) are filled with -1.
+
+    :param locations: list of tuples, or None
+    :param count: length of the array (used when `locations` is None)
+    :return: np.ndarray of shape (N, 4)
+    """
+    array = np.full((count, 4), -1, dtype=np.int32)
+    if locations is not None:
+        for idx, loc in enumerate(locations):
+            if loc is not None:
+                array[idx] = loc
+    return array
 
 
 def _rect_to_tuple(r):
@@ -295,33 +766,182 @@ def _tuple_to_rect(t):
     return dlib.rectangle(*t)
 
 
-def detect(img, *, upsample=1):
+def _as_array(img):
+    """
+    Helper function.
+
+    Brings an image back from a `cv2.UMat` (see `preprocess`) to a numpy array,
+    which is what dlib works with. Numpy arrays are returned as they are.
+
+    :param img: numpy/cv2 image array or `cv2.UMat`
+    :return: numpy/cv2 image array
+    """
+    if isinstance(img, cv2.UMat):
+        return img.get()
+    return img
+
+
+def set_preproc_device(device):
+    """
+    Chooses where `preprocess` runs.
+
+    With "gpu", images are wrapped in `cv2.UMat` and OpenCVs transparent API
+    runs the resizing and color conversions on an OpenCL device (OpenCV falls
+    back to the CPU if there's none available). The functions of this module
+    take care of bringing the images back to numpy arrays before handing them
+    to dlib, which always works on CPU.
+
+    :param device: "cpu" (default) or "gpu"
+    """
+    global _preproc_device, _opencl_before
+    if device not in ("cpu", "gpu"):
+        raise ValueError("Invalid value for `device` parameter.")
+    if device == "gpu" and _preproc_device == "cpu":
+        _opencl_before = cv2.ocl.useOpenCL()
+        cv2.ocl.setUseOpenCL(True)
+    elif device == "cpu" and _preproc_device == "gpu":
+        # back to whatever the caller had, so unrelated cv2 code isn't affected
+        cv2.ocl.setUseOpenCL(_opencl_before)
+    _preproc_device = device
+
+
+def preprocess(img, *, size=None, scale=None, rgb=False, inter=cv2.INTER_LINEAR):
+    """
+    Resizes and/or color-converts an image before detecting faces on it, on the
+    device chosen with `set_preproc_device`.
+
+    :param img: numpy/cv2 image array
+    :param size: tuple of ints (width, height) to resize the image to
+    :param scale: float, scale factor for the image (only used if `size` is
+        None)
+    :param rgb: convert the image from BGR to RGB
+    :param inter: interpolation algorithm from cv2 (see cv2.INTER_ constants)
+    :return: numpy/cv2 image array, or `cv2.UMat` when the device is "gpu". Both
+        can be passed to `detect`, `landmark`, `encode` and `process`
+    """
+    if _preproc_device == "gpu":
+        img = cv2.UMat(img)
+    if size is not None:
+        img = cv2.resize(img, size, interpolation=inter)
+    elif scale is not None:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=inter)
+    if rgb:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+
+def preload(*, encoder=True, detector=True, shape=True, gender=False, cnn=False):
+    """
+    Loads the models used by this module ahead of time.
+
+    Models are lazily loaded on their first use, which makes that first call
+    noticeably slower (the face encoder alone is a ~22MB network). Long running
+    programs, like servers or video pipelines, can call this once at startup
+    (eg: in a FastAPI `@app.on_event("startup")` handler) to keep that stall
+    out of the first request or frame.
+
+    :param encoder: load the face encoder
+    :param detector: load the HOG face detector
+    :param shape: load the 5 and 68 point shape predictors
+    :param gender: load the gender model
+    :param cnn: load the CNN face detector
+    """
+    keys = []
+    if detector:
+        keys.append("face_detector")
+    if cnn:
+        keys.append("face_detector_cnn")
+    if shape:
+        keys.extend(["shape_predictor_5p", "shape_predictor_68p"])
+    if encoder:
+        keys.append("face_encoder")
+    if gender:
+        keys.append("gender_model")
+    lazy_vars.warm(keys)
+
+
+def detect(img, *, upsample=1, backend="hog"):
     """
     Detects faces present in an image.
 
-    Wrapper of dlibs frontal face detector.
+    Wrapper of dlibs frontal face detector (HOG based), and of the other
+    available face detectors.
 
     :param img: numpy/cv2 image array
     :param upsample: int, number of times to upsample the image. Helps finding
-        smaller faces
+        smaller faces (ignored by the "yunet" backend)
+    :param backend: face detector to use. "hog" (default) is dlibs frontal face
+        detector, "cnn" is dlibs CNN detector (see `detect_cnn`) and "yunet" is
+        OpenCVs YuNet, a much faster detector on CPU. YuNet needs OpenCV 4.8+
+        and its model file in phantom/models (see the README there)
     :return: list of tuples (left, top, right, bottom) with each face location
     """
-    face_detector = lazy_vars.get("face_detector")
-    return [_rect_to_tuple(r) for r in face_detector(img, upsample)]
+    img = _as_array(img)
+    if backend == "hog":
+        face_detector = _get_model("face_detector")
+        return [_rect_to_tuple(r) for r in face_detector(img, upsample)]
+    elif backend == "cnn":
+        return detect_cnn(img, upsample=upsample)
+    elif backend == "yunet":
+        return _detect_yunet(img)
+    else:
+        raise ValueError("Invalid value for `backend` parameter.")
+
+
+def _detect_yunet(img):
+    """
+    Helper function for `detect`, runs the YuNet face detector over `img`.
+
+    :param img: numpy/cv2 image array
+    :return: list of tuples (left, top, right, bottom) with each face location
+    """
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    detector = _get_model("face_detector_yunet")
+    height, width = img.shape[:2]
+    detector.setInputSize((width, height))
+    _, faces = detector.detect(img)
+    if faces is None:
+        return []
+    return [(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h, *_ in faces]
 
 
 def detect_cnn(img, *, upsample=1):
     """
-    Detects faces present in an image, using `cv2.dnn` module.
-    
-    Work in progress.
-    :param upsample: (Note: for now it's just to be compatible with the `detect`
-        signature, may not be necessary)
+    Detects faces present in an image, using dlibs CNN face detector.
+
+    Wrapper of dlibs `cnn_face_detection_model_v1`. It's more accurate than
+    `detect`, but unless dlib was compiled with CUDA support it's much slower,
+    so `detect` remains the default choice on CPU.
+
+    :param img: numpy/cv2 image array
+    :param upsample: int, number of times to upsample the image. Helps finding
+        smaller faces
     :return: list of tuples (left, top, right, bottom) with each face location
     """
-    detections = []
-    # TODO: implement dlibs face detecting CNN
-    return detections
+    img = _as_array(img)
+    cnn_detector = _get_model("face_detector_cnn")
+    return [_rect_to_tuple(d.rect) for d in cnn_detector(img, upsample)]
+
+
+def detect_cnn_batch(imgs, *, upsample=1, batch_size=128):
+    """
+    Detects faces present in a list of images, using dlibs CNN face detector.
+
+    The images are run through the network in batches, which is where a GPU
+    pays off. All the images must have the same size.
+
+    :param imgs: list of numpy/cv2 image arrays
+    :param upsample: int, number of times to upsample the images. Helps finding
+        smaller faces
+    :param batch_size: number of images to process at once
+    :return: list (one element per image) of lists of tuples (left, top, right,
+        bottom) with each face location
+    """
+    imgs = [_as_array(img) for img in imgs]
+    cnn_detector = _get_model("face_detector_cnn")
+    results = cnn_detector(imgs, upsample, batch_size)
+    return [[_rect_to_tuple(d.rect) for d in detections] for detections in results]
 
 
 def landmark(img, *, locations=None, model=Shape68p, upsample=1):
@@ -339,16 +959,15 @@ def landmark(img, *, locations=None, model=Shape68p, upsample=1):
     :return: list of `phantom.faces.Shape` objects, each describing the position
         and landmarks of every face
     """
+    img = _as_array(img)
     if locations is None:
         locations = detect(img, upsample=upsample)
-    class_ = model
-    shaper = model([(i, i) for i in range(68)])
-    model = shaper.model  # TODO: might want to improve the names here
-    shapelist = [model(img, _tuple_to_rect(loc)) for loc in locations]
-    return [class_([(p.x, p.y) for p in face.parts()]) for face in shapelist]
+    predictor = _shape_predictor(model)
+    shapelist = [predictor(img, _tuple_to_rect(loc)) for loc in locations]
+    return [model([(p.x, p.y) for p in face.parts()]) for face in shapelist]
 
 
-def encode(img, *, locations=None, model=Shape68p, jitter=1):
+def encode(img, *, locations=None, model=Shape68p, jitter=1, cache=True):
     """
     Detects and encodes all the faces in an image.
 
@@ -361,14 +980,145 @@ def encode(img, *, locations=None, model=Shape68p, jitter=1):
     :param jitter: an integer number of times to scramble the image a bit, and
         re-run the encoding. Higher jitter makes for slightly better encodings,
         though it slows down the encoding.
+    :param cache: reuse the encodings of faces that were already encoded (same
+        image contents, location, model and jitter), instead of running the
+        encoder again. Hashing the image is far cheaper than encoding a face
+    :return: float16 np.ndarray of shape (N, 128), one encoding per face. Half
+        precision is plenty for dlibs encodings, and halves the memory they take
     """
+    img = _as_array(img)
     if locations is None:
         locations = detect(img)
-    shaper = model([(i, i) for i in range(68)])
-    model = shaper.model  # once again this shadowing...
-    face_encoder = lazy_vars.get("face_encoder")
-    shapelist = [model(img, _tuple_to_rect(loc)) for loc in locations]
-    return [np.array(face_encoder.compute_face_descriptor(img, shape, jitter)) for shape in shapelist]
+    encodings = np.empty((len(locations), 128), dtype=np.float16)
+    keys = [None] * len(locations)
+    if cache:
+        digest = _digest(img)
+        keys = [(digest, img.shape, tuple(loc), model, jitter) for loc in locations]
+    missing = []
+    for idx, key in enumerate(keys):
+        cached = _encoding_cache.get(key) if cache else None
+        if cached is None:
+            missing.append(idx)
+        else:
+            encodings[idx] = cached
+    if not missing:
+        return encodings
+    predictor = _shape_predictor(model)
+    face_encoder = _get_model("face_encoder")
+    shapelist = [predictor(img, _tuple_to_rect(locations[idx])) for idx in missing]
+    vectors = _encode_batch(face_encoder, img, shapelist, jitter)
+    encodings[missing] = np.asarray(vectors, dtype=np.float16)
+    if cache:
+        for idx in missing:
+            _encoding_cache.put(keys[idx], encodings[idx].copy())
+    return encodings
+
+
+def detect_many(imgs, *, upsample=1, backend="hog", workers=None):
+    """
+    Detects faces present in many images, in parallel.
+
+    dlib releases the GIL while it works, so the images are spread over a pool
+    of threads.
+
+    Detectors can't be shared between threads, so each worker uses its own.
+    Those copies are kept and reused by later calls, so they're loaded only
+    once per worker.
+
+    :param imgs: iterable of numpy/cv2 image arrays
+    :param upsample: int, number of times to upsample the images (see `detect`)
+    :param backend: face detector to use (see `detect`)
+    :param workers: number of threads, or None to let `concurrent.futures`
+        decide
+    :return: list (one element per image) of lists of tuples (left, top, right,
+        bottom) with each face location
+    """
+    detector = functools.partial(detect, upsample=upsample, backend=backend)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_with_models, itertools.repeat(detector), imgs))
+
+
+def _encode_one(img, locations, model, jitter):
+    """
+    Helper function for `encode_many`. It has to be a module level function so
+    it can be sent to worker processes.
+    """
+    return encode(img, locations=locations, model=model, jitter=jitter)
+
+
+def encode_many(imgs, *, locations=None, model=Shape68p, jitter=1, workers=None,
+                processes=False):
+    """
+    Detects and encodes all the faces in many images, in parallel.
+
+    The shape predictor is loaded once and shared, while each worker uses its
+    own face detector and encoder, since those can't be shared between threads.
+    Those copies are kept and reused by later calls, so they're loaded only
+    once per worker.
+
+    :param imgs: list of numpy/cv2 image arrays
+    :param locations: list (one element per image) of lists of tuples (left,
+        top, right, bottom) with face locations, or None to detect them
+    :param model: shape predictor
+    :param jitter: see `encode`
+    :param workers: number of workers, or None to let `concurrent.futures`
+        decide
+    :param processes: use a pool of processes instead of threads. Only useful
+        if your dlib build doesn't release the GIL, since the images have to be
+        copied to each process
+    :return: list (one element per image) of np.ndarrays with the encodings
+        (see `encode`)
+    """
+    imgs = list(imgs)
+    if locations is None:
+        locations = [None] * len(imgs)
+    count = len(imgs)
+    if len(locations) != count:
+        raise ValueError("`locations` must have one element per image.")
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    if not processes:
+        _shape_predictor(model)  # load it before the threads race for it
+    with pool(max_workers=workers) as executor:
+        return list(executor.map(
+            _run_with_models, itertools.repeat(_encode_one), imgs, locations,
+            itertools.repeat(model, count), itertools.repeat(jitter, count)
+        ))
+
+
+def process(img, *, upsample=1, model=Shape68p, jitter=1, want=("landmarks", "encoding")):
+    """
+    Detects, landmarks and encodes all the faces in an image, in a single pass.
+
+    Same results as calling `detect`, `landmark` and `encode` in a row, but
+    every face is located and shape-predicted only once, and the encoder gets
+    small aligned face chips instead of the whole image.
+
+    :param img: numpy/cv2 image array
+    :param upsample: int, number of times to upsample the image. Helps finding
+        smaller faces
+    :param model: `Shape` subclass that defines a landmarking model.
+    :param jitter: an integer number of times to scramble the image a bit, and
+        re-run the encoding (see `encode`)
+    :param want: which of "landmarks" and "encoding" to compute
+    :return: list of `phantom.faces.Face` objects, with their location, and
+        landmark and/or encoding filled according to `want`
+    """
+    img = _as_array(img)
+    locations = detect(img, upsample=upsample)
+    if not locations:
+        return []
+    predictor = _shape_predictor(model)
+    shapelist = [predictor(img, _tuple_to_rect(loc)) for loc in locations]
+    faces = [Face(location=loc) for loc in locations]
+    if "landmarks" in want:
+        for face, shape in zip(faces, shapelist):
+            face.landmark = model([(p.x, p.y) for p in shape.parts()])
+    if "encoding" in want:
+        face_encoder = _get_model("face_encoder")
+        vectors = _encode_aligned(face_encoder, img, shapelist, jitter)
+        for face, vector in zip(faces, np.asarray(vectors, dtype=np.float16)):
+            face.encoding = vector
+    return faces
 
 
 def compare(face1, face2):
@@ -384,7 +1134,98 @@ def compare(face1, face2):
     :param face2: dlibs 128-long face encoding
     :return: float, distance between `face1` and `face2`
     """
-    return np.linalg.norm(face1 - face2)
+    # encodings are stored as float16, but the distance is computed in float32
+    return np.linalg.norm(np.subtract(face1, face2, dtype=np.float32))
+
+
+# rows per block when expanding int8 encodings in `compare_many` (~512KB of
+# float32, sized to stay in L2 cache)
+_block_rows = 1024
+
+
+# below this many rows, numba's thread startup costs more than it saves
+_numba_min_rows = 256
+
+
+@functools.lru_cache(maxsize=1)
+def _l2_kernel():
+    """
+    Compiles (on first use only) the numba kernel for `_distances`. numba is
+    imported here rather than at module level, since importing it noticeably
+    slows down `import phantom.faces`.
+
+    :return: numba kernel `_l2_many(q, E, out)`, that writes to `out` the
+        euclidean distance between `q` and each row of `E`, spreading the rows
+        over all cores; or None if numba isn't installed (it's optional)
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _l2_many(q, E, out):
+        for i in prange(E.shape[0]):
+            s = 0.0
+            for j in range(E.shape[1]):
+                d = E[i, j] - q[j]
+                s += d * d
+            out[i] = math.sqrt(s)
+
+    return _l2_many
+
+
+def _distances(query, encodings):
+    """
+    Helper function for `compare_many`.
+
+    Euclidean distance between `query` and each row of `encodings`, as float32.
+    Uses a numba kernel for large inputs when numba is available; otherwise the
+    heavy term is a single matrix-vector product.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    encodings = np.asarray(encodings, dtype=np.float32)
+    l2_many = _l2_kernel() if len(encodings) > _numba_min_rows else None
+    if l2_many is not None:
+        distances = np.empty(len(encodings), dtype=np.float32)
+        l2_many(query, np.ascontiguousarray(encodings), distances)
+        return distances
+    sq_dist = (encodings * encodings).sum(axis=1) + query @ query - 2 * (encodings @ query)
+    # rounding can leave tiny negative values for (almost) identical faces
+    return np.sqrt(np.maximum(sq_dist, 0))
+
+
+def compare_many(query, encodings, *, scale=None):
+    """
+    Compares a face encoding against many others at once.
+
+    Same as calling `compare` on each row of `encodings`, but the bulk of the
+    work is done in a single matrix-vector product.
+
+    Quantized int8 encodings (see `Atlas.encodings_i8`) are also accepted, along
+    with their per-column `scale`. int8 and float16 encodings (eg: a loaded
+    Atlas) are expanded to float32 in blocks small enough to stay in cache, so
+    only the compact matrix is read from memory.
+
+    :param query: dlibs 128-long face encoding
+    :param encodings: np.ndarray of shape (N, 128), for example `Atlas.encodings`
+    :param scale: 128-long np.ndarray, needed (only) for int8 `encodings`
+    :return: np.ndarray of N floats, distance between `query` and each encoding
+    """
+    encodings = np.asarray(encodings)
+    if encodings.dtype == np.float32:
+        return _distances(query, encodings)
+    if encodings.dtype == np.int8:
+        if scale is None:
+            raise ValueError("`scale` is needed to compare against int8 encodings.")
+        scale = np.asarray(scale, dtype=np.float32)
+    else:
+        scale = np.float32(1)
+    distances = np.empty(len(encodings), dtype=np.float32)
+    for start in range(0, len(encodings), _block_rows):
+        block = encodings[start:start + _block_rows] * scale
+        distances[start:start + _block_rows] = _distances(query, block)
+    return distances
 
 
 def estimate_gender(face):
@@ -398,6 +1239,25 @@ def estimate_gender(face):
         the model is not certain enough, and should be considered as "unknown"
         or "uncertain"
     """
-    vector = dlib.vector(face)
+    vector = dlib.vector(np.asarray(face, dtype=np.float64).tolist())
     gender_model = lazy_vars.get("gender_model")
     return gender_model(vector)
+
+
+def estimate_gender_many(encodings):
+    """
+    Estimates the gender (see `estimate_gender`) of many faces at once.
+
+    If the gender model is a scikit-learn estimator, all the faces go through
+    a single `decision_function` call. dlibs models don't have a batched call,
+    so they're evaluated face by face.
+
+    :param encodings: np.ndarray of shape (N, 128), for example
+        `Atlas.encodings`
+    :return: np.ndarray of N floats, estimated gender for each face
+    """
+    gender_model = lazy_vars.get("gender_model")
+    encodings = np.asarray(encodings, dtype=np.float64)
+    if hasattr(gender_model, "decision_function"):
+        return gender_model.decision_function(encodings)
+    return np.array([gender_model(dlib.vector(e.tolist())) for e in encodings])
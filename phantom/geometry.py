@@ -18,25 +18,22 @@ class Grid:
         self.size = size
     
     def _draw_lines(self, img, color, thick, direction="h", debug=False):
-        for panel in self.panels:
-            p, q, r, s = map(tuple, panel)  # unpack the tuple
+        # the edges of each panel, walked as a closed polygon: p-q-s-r for
+        # horizontal grids, p-q-r-s for vertical ones
+        order = [0, 1, 3, 2] if direction == "h" else [0, 1, 2, 3]
+        polygons = [np.asarray(panel, dtype=np.int32)[order] for panel in self.panels]
+        if debug:
+            # only the first panel, with its corners marked
+            polygons = polygons[:1]
+        cv2.polylines(img, polygons, True, color, thickness=thick)
+        if debug:
+            # corner markers go on top of the edges
+            p, q, r, s = map(tuple, self.panels[0])
             print(f"p:{p}, q:{q}, r:{r}, s:{s}")
-            if direction == "h":
-                cv2.line(img, p, q, color, thickness=thick)
-                cv2.line(img, p, r, color, thickness=thick)
-                cv2.line(img, q, s, color, thickness=thick)
-                cv2.line(img, r, s, color, thickness=thick)
-            else:
-                cv2.line(img, p, q, color, thickness=thick)
-                cv2.line(img, p, s, color, thickness=thick)
-                cv2.line(img, q, r, color, thickness=thick)
-                cv2.line(img, r, s, color, thickness=thick)
-            if debug:
-                cv2.circle(img, p, thick, (  0,   0, 255), thickness=thick)
-                cv2.circle(img, q, thick, (  0, 255, 255), thickness=thick)
-                cv2.circle(img, r, thick, (  0, 255,   0), thickness=thick)
-                cv2.circle(img, s, thick, (255, 255,   0), thickness=thick)
-                break
+            cv2.circle(img, p, thick, (  0,   0, 255), thickness=thick)
+            cv2.circle(img, q, thick, (  0, 255, 255), thickness=thick)
+            cv2.circle(img, r, thick, (  0, 255,   0), thickness=thick)
+            cv2.circle(img, s, thick, (255, 255,   0), thickness=thick)
         return None
     
     def _draw_points(self, img, color, thick):
@@ -44,9 +41,13 @@ class Grid:
         Subclasses can define the logic for drawing this shape over an image,
         using points, however a base implementation is provided.
         """
-        for panel in self.panels:
-            for point in panel:
-                cv2.circle(img, tuple(point), thick, color, thickness=thick)
+        if len(self.panels) == 0:
+            return None
+        points = np.concatenate([np.asarray(panel, dtype=np.int32) for panel in self.panels])
+        # each point becomes a zero-length segment, which cv2 draws as a round
+        # dot -- this way all the points are drawn with a single call
+        dots = np.repeat(points[:, np.newaxis], 2, axis=1)
+        cv2.polylines(img, dots, False, color, thickness=3 * thick)
         return None
     
     def equivalent(self, other):
@@ -37,6 +37,6 @@ setup(
     packages = find_packages(),
     #packages = ['phantom'],
     package_dir={'phantom': 'phantom'},
-    package_data={'phantom': ['models/*.dat']},
+    package_data={'phantom': ['models/*.dat', 'models/*.onnx']},
 #
     )
\ No newline at end of file
@@ -196,14 +196,14 @@ def train(tagged):
     for i, t in enumerate(tagged):
         print(f"\rEncoding {t.path} ({i + 1}/{total})...", end="")
         faces = encode(t.img)
-        x.append(dlib.vector(faces[0]))
+        x.append(dlib.vector(faces[0].tolist()))
         y.append(t.tag)
         img = t.img
         for _ in range(5):
             faces = encode(img)
-            if not faces:
+            if len(faces) == 0:
                 break
-            x.append(dlib.vector(faces[0]))
+            x.append(dlib.vector(faces[0].tolist()))
             y.append(t.tag)
             img = cv2.resize(img,None,fx=0.7,fy=0.7)
 